@@ -7,9 +7,8 @@ Created on Sat Jun 20 12:30:08 2020
 Autoencoders learn a mapping from a high dimensional space to a lower
 dimensional space, as well as the inverse.
 """
+import os
 from abc import abstractmethod
-from functools import reduce
-from operator import mul
 
 import numpy as np
 import tensorflow as tf
@@ -25,6 +24,10 @@ from layers.layer_functions import generate_activation_layers
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 crossentropy = tf.keras.losses.BinaryCrossentropy(from_logits=True)
 
+# Any FP32 convolutions remaining under a mixed precision policy can still
+# use TF32 tensor cores on Ampere and above.
+os.environ.setdefault('NVIDIA_TF32_OVERRIDE', '1')
+
 
 def define_discriminator(input_shape, hidden_size=None):
     """For placing adversarial constraints on latent distribution p(z|x).
@@ -74,6 +77,8 @@ class AutoEncoderBase(tf.keras.Model):
                  metric_distance_threshold=-1.0,
                  adversarial=False,
                  adversarial_variance=10.0,
+                 xla=True,
+                 mixed_precision=None,
                  **opt_args):
         """Setup and compilation of autoencoder.
 
@@ -87,10 +92,32 @@ class AutoEncoderBase(tf.keras.Model):
             learning_rate_schedule: instance of class derived from
                 LearningRateSchedule which can be called with the iteration
                 number as an argument to give a learning rate
+            xla: cluster and fuse graph operations with the XLA JIT compiler;
+                input dimensions are static so there is no per-batch
+                recompilation penalty
+            mixed_precision: keras mixed precision policy name
+                ('mixed_float16' for V100/T4-class GPUs, 'mixed_bfloat16' for
+                A100/TPU); convolutions and activations run at reduced
+                precision on tensor cores while weights, model outputs and
+                loss accumulation stay in float32. None (default) leaves
+                everything in float32.
             opt_args: arguments for the keras optimiser (see keras
                 documentation)
         """
 
+        # Auto-clustering fuses the many small elementwise ops surrounding
+        # the Conv3D/BN stacks in the dense and residual blocks into single
+        # kernels, avoiding round trips to global memory between layers.
+        if xla:
+            tf.config.optimizer.set_jit(True)
+
+        # Must be set before any layers are constructed; None explicitly
+        # resets to float32 so that a policy set by a previously constructed
+        # model in the same process is not silently inherited
+        self.mixed_precision = mixed_precision
+        tf.keras.mixed_precision.set_global_policy(
+            mixed_precision if mixed_precision is not None else 'float32')
+
         self.initialiser = tf.keras.initializers.HeNormal()  # weights init
         self.learning_rate_schedule = learning_rate_schedule
         self.encoding_size = encoding_size
@@ -118,6 +145,17 @@ class AutoEncoderBase(tf.keras.Model):
         elif isinstance(optimiser, str):
             optimiser = tf.keras.optimizers.get(optimiser).__class__
 
+        def make_optimiser():
+            """Instantiate the optimiser, with loss scaling if required.
+
+            FP16 gradients underflow without dynamic loss scaling; BF16 has
+            the same exponent range as FP32 so no scaling is needed.
+            """
+            opt = optimiser(**opt_args)
+            if mixed_precision == 'mixed_float16':
+                opt = tf.keras.mixed_precision.LossScaleOptimizer(opt)
+            return opt
+
         inputs = [self.input_image]
 
         # Do we need to calculate and input the (expensive) distance-to-ligand
@@ -137,6 +175,11 @@ class AutoEncoderBase(tf.keras.Model):
             inputs=inputs, outputs=[self.reconstruction, self.encoding],
             name='autoencoder')
 
+        # Dedicated graph-mode inference path; traced on first call and
+        # reused thereafter, avoiding the per-call data-adapter and callback
+        # machinery of the keras predict_* methods
+        self.infer = tf.function(lambda x: self(x, training=False))
+
         metrics = {
             'reconstruction': [mae, nonzero_mae, zero_mse,
                                nonzero_mse, trimmed_nonzero_mae,
@@ -162,26 +205,26 @@ class AutoEncoderBase(tf.keras.Model):
             self.add_loss(composite_mse(
                 self.input_image, self.reconstruction, self.frac))
             self.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 metrics=metrics
             )
         elif loss == 'distance_mse':
             self.add_loss(proximity_mse(
                 self.input_image, self.reconstruction, self.distances))
             self.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 metrics=metrics
             )
         elif loss == 'mse':
             self.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 loss={'reconstruction': SquaredError(reduction='none'),
                       'encoding': None},
                 metrics=metrics
             )
         else:
             self.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 loss={'reconstruction': loss,
                       'encoding': None},
                 metrics=metrics
@@ -191,14 +234,14 @@ class AutoEncoderBase(tf.keras.Model):
             encoder = tf.keras.models.Model(
                 self.input_image, outputs=self.encoding, name='encoder')
             encoder.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 loss={'encoding': 'binary_crossentropy'}
             )
 
             discriminator = define_discriminator(
                 (encoding_size,), 2 * encoding_size)
             discriminator.compile(
-                optimizer=optimiser(**opt_args),
+                optimizer=make_optimiser(),
                 loss=disc_loss_fn,
                 metrics=disc_loss_fn
             )
@@ -357,7 +400,7 @@ class DenseAutoEncoder(AutoEncoderBase):
         x = layers.Dense(encoding_size, kernel_initializer=self.initialiser)(x)
         encoding = encoding_activation_layer(x)
 
-        decoding = layers.Dense(reduce(mul, final_shape[1:]),
+        decoding = layers.Dense(int(np.prod(final_shape[1:])),
                                 kernel_initializer=self.initialiser)(encoding)
         decoding = decoding_activation_layer(decoding)
 
@@ -371,11 +414,13 @@ class DenseAutoEncoder(AutoEncoderBase):
             x, 0.5, 'itb_2', hidden_activation)
         x = dense.tf_dense_block(x, blocks, 'idb_2', hidden_activation)
 
+        # Output layer stays in float32 under mixed precision policies so
+        # that losses and metrics are accumulated at full precision
         reconstruction = layers.Conv3D(dims[0], 3,
                                        activation=final_activation,
                                        kernel_initializer=self.initialiser,
                                        data_format='channels_first',
-                                       use_bias=False,
+                                       use_bias=False, dtype='float32',
                                        padding='SAME', name='reconstruction')(x)
 
         return input_image, encoding, reconstruction
@@ -398,9 +443,13 @@ class SingleLayerAutoEncoder(AutoEncoderBase):
         x = layers.Dense(encoding_size)(x)
         encoding = encoding_activation_layer(x)
 
+        # The Reshape must also be pinned to float32: it follows the pinned
+        # Dense layer, so under a mixed precision policy it would otherwise
+        # cast the model output back to float16
         x = layers.Dense(np.prod(dims),
-                         activation=final_activation)(encoding)
-        reconstruction = layers.Reshape(dims, name='reconstruction')(x)
+                         activation=final_activation, dtype='float32')(encoding)
+        reconstruction = layers.Reshape(
+            dims, name='reconstruction', dtype='float32')(x)
 
         return input_image, encoding, reconstruction
 
@@ -459,7 +508,7 @@ class MultiLayerAutoEncoder(AutoEncoderBase):
 
         reconstruction = layers.Conv3DTranspose(
             dims[0], 3, 2, activation=final_activation, name='reconstruction',
-            **conv_args)(x)
+            dtype='float32', **conv_args)(x)
 
         return input_image, encoding, reconstruction
 
@@ -551,11 +600,62 @@ class ResidualAutoEncoder(AutoEncoderBase):
         reconstruction = layers.Conv3DTranspose(dims[0], 3, 2,
                                                 name='reconstruction',
                                                 activation=final_activation,
+                                                dtype='float32',
                                                 **conv_args)(x)
 
         return input_image, encoding, reconstruction
 
 
+def prune_kernel_2_4(kernel):
+    """Apply 2:4 structured magnitude pruning to a dense kernel.
+
+    In every group of four consecutive weights along the input (reduction)
+    dimension, the two smallest in magnitude are set to zero. Kernels in
+    this pattern can be executed by Ampere sparse tensor cores (for example
+    via TensorRT or cuSPARSELt), which skip the zeroed multiplications for
+    roughly double the GEMM throughput.
+
+    Arguments:
+        kernel: 2D numpy array of weights with shape (inputs, outputs)
+
+    Returns:
+        Pruned copy of kernel. If the input dimension is not a multiple of
+        four, the trailing weights are left unpruned.
+    """
+    kernel = np.array(kernel)
+    whole_groups = (kernel.shape[0] // 4) * 4
+    groups = kernel[:whole_groups].reshape(-1, 4, kernel.shape[1])
+    smallest = np.argsort(np.abs(groups), axis=1)[:, :2, :]
+    np.put_along_axis(groups, smallest, 0., axis=1)
+    kernel[:whole_groups] = groups.reshape(whole_groups, -1)
+    return kernel
+
+
+def apply_2_4_sparsity(model):
+    """Prune the kernels of all Dense layers in a model to the 2:4 pattern.
+
+    Intended for use after training; the decoder Dense layer of a
+    DenseAutoEncoder is usually its largest parameter block, so pruning it
+    both halves the work done by sparse-tensor-core GEMMs and shrinks the
+    saved model. A short period of further training after pruning recovers
+    most of the lost accuracy (although the recovered weights are no longer
+    guaranteed to fit the pattern).
+
+    Arguments:
+        model: trained keras model (for example an AutoEncoderBase object)
+
+    Returns:
+        The number of Dense layers which were pruned (in place).
+    """
+    pruned = 0
+    for layer in model.layers:
+        if isinstance(layer, layers.Dense):
+            kernel, *rest = layer.get_weights()
+            layer.set_weights([prune_kernel_2_4(kernel)] + rest)
+            pruned += 1
+    return pruned
+
+
 class SquaredError(tf.keras.losses.Loss):
     """Implementation of the squared error with no reduction.
 
@@ -585,6 +685,56 @@ class SquaredError(tf.keras.losses.Loss):
                               axis=self.reduction_axis)
 
 
+def _masked_stats(target, reconstruction):
+    """Shared single-pass statistics for the masked MSE and MAE metrics.
+
+    The difference between the target and the reconstruction, along with the
+    nonzero mask, are materialised once and reused for all five masked
+    metrics, rather than once per metric; the input grids are large and
+    sparse so these metrics are bound by memory traffic rather than FLOPs.
+
+    This is a plain python function rather than a tf.function: it is called
+    with symbolic tensors at model construction time (via add_metric and
+    add_loss), and its ops join the surrounding (XLA-clustered) train graph.
+
+    Arguments:
+        target: input tensor
+        reconstruction: output tensor of the autoencoder
+
+    Returns:
+        Tuple of scalar tensors containing the overall MAE, the MSE over
+        nonzero and zero entries of the target (both normalised by the total
+        grid size), and the MAE over nonzero and zero entries of the target
+        (normalised by the nonzero and zero entry counts, respectively).
+    """
+    # Accumulate at full precision under mixed precision policies
+    target = tf.cast(target, tf.float32)
+    reconstruction = tf.cast(reconstruction, tf.float32)
+    difference = target - reconstruction
+    abs_diff = tf.abs(difference)
+    sq_diff = tf.square(difference)
+    mask = tf.cast(tf.not_equal(target, 0), tf.float32)
+    nonzero_count = tf.math.count_nonzero(target, dtype=tf.float32)
+    total = tf.cast(tf.size(target), tf.float32)
+    zero_count = total - nonzero_count
+    # The zero-masked sums are the complements of the nonzero-masked sums,
+    # so derive them by subtraction rather than a second masked pass
+    sum_abs = tf.reduce_sum(abs_diff)
+    sum_sq = tf.reduce_sum(sq_diff)
+    nonzero_sum_abs = tf.reduce_sum(abs_diff * mask)
+    nonzero_sum_sq = tf.reduce_sum(sq_diff * mask)
+    overall_mae = sum_abs / total
+    nonzero_mse_total = nonzero_sum_sq / total
+    zero_mse_total = (sum_sq - nonzero_sum_sq) / total
+    # divide_no_nan guards against empty masks (all-zero or all-nonzero
+    # targets) in-graph, returning zero rather than NaN
+    nonzero_mae_mean = tf.math.divide_no_nan(nonzero_sum_abs, nonzero_count)
+    zero_mae_mean = tf.math.divide_no_nan(
+        sum_abs - nonzero_sum_abs, zero_count)
+    return (overall_mae, nonzero_mse_total, zero_mse_total,
+            nonzero_mae_mean, zero_mae_mean)
+
+
 def nonzero_mse(target, reconstruction):
     """Mean squared error for non-zero values in the target matrix
 
@@ -596,11 +746,10 @@ def nonzero_mse(target, reconstruction):
         reconstruction: output tensor of the autoencoder
 
     Returns:
-        Mean squared error for all non-zero entries in the target
+        Mean squared error for all non-zero entries in the target,
+        normalised by the total size of the target
     """
-    mask = tf.cast(tf.not_equal(target, 0), tf.float32)
-    masked_difference = (target - reconstruction) * mask
-    return tf.square(masked_difference)
+    return _masked_stats(target, reconstruction)[1]
 
 
 def zero_mse(target, reconstruction):
@@ -614,11 +763,10 @@ def zero_mse(target, reconstruction):
         reconstruction: output tensor of the autoencoder
 
     Returns:
-        Mean squared error for all zero entries in the target
+        Mean squared error for all zero entries in the target, normalised
+        by the total size of the target
     """
-    mask = tf.cast(tf.equal(target, 0), tf.float32)
-    masked_difference = (target - reconstruction) * mask
-    return tf.square(masked_difference)
+    return _masked_stats(target, reconstruction)[2]
 
 
 def composite_mse(target, reconstruction, ratio):
@@ -628,6 +776,11 @@ def composite_mse(target, reconstruction, ratio):
     entries of the input, the MSE between the reconstruction and the zero
     entries of the input and gives the weighted average of the two.
 
+    Called with symbolic tensors at model construction time (via add_loss)
+    so must remain a plain python function; fusion of the elementwise chain
+    over the reconstruction is left to the XLA auto-clustering enabled by
+    the xla constructor flag.
+
     Arguments:
         target: input tensor
         reconstruction: output tensor of the autoencoder
@@ -779,7 +932,7 @@ def mae(target, reconstruction):
         Tensor containing the mean absolute error between the target and
         the reconstruction.
     """
-    return tf.reduce_mean(tf.abs(target - reconstruction))
+    return _masked_stats(target, reconstruction)[0]
 
 
 def zero_mae(target, reconstruction):
@@ -793,13 +946,9 @@ def zero_mae(target, reconstruction):
         Tensor containing the mean absolute error between the target and
         the reconstruction where the mean is taken over values where
         the target is equal to zero.
-        This can be NaN if there are no inputs equal to zero.
+        This is zero if there are no inputs equal to zero.
     """
-    mask = tf.cast(tf.equal(target, 0), tf.float32)
-    mask_sum = tf.reduce_sum(mask)
-    abs_diff = tf.abs(target - reconstruction)
-    masked_abs_diff = tf.math.multiply(abs_diff, mask)
-    return tf.reduce_sum(masked_abs_diff) / mask_sum
+    return _masked_stats(target, reconstruction)[4]
 
 
 def nonzero_mae(target, reconstruction):
@@ -813,13 +962,9 @@ def nonzero_mae(target, reconstruction):
         Tensor containing the mean absolute error between the target and
         the reconstruction where the mean is taken over values where
         the target is not zero.
-        This can be NaN if there are no nonzero inputs.
+        This is zero if there are no nonzero inputs.
     """
-    mask = tf.cast(tf.not_equal(target, 0), tf.float32)
-    abs_diff = tf.abs(target - reconstruction)
-    masked_abs_diff = tf.math.multiply(abs_diff, mask)
-    mask_sum = tf.reduce_sum(mask)
-    return tf.reduce_sum(masked_abs_diff) / mask_sum
+    return _masked_stats(target, reconstruction)[3]
 
 
 def trimmed_nonzero_mae(target, reconstruction):
@@ -835,7 +980,7 @@ def trimmed_nonzero_mae(target, reconstruction):
         Tensor containing the mean absolute error between the target and
         the reconstruction where the mean is taken over values where
         the target is not zero.
-        This can be NaN if there are no nonzero inputs.
+        This is zero if there are no nonzero inputs.
     """
     _, _, x, y, z = target.shape
     begin = [0, 0, 3, 3, 3]
@@ -858,7 +1003,7 @@ def trimmed_zero_mae(target, reconstruction):
         Tensor containing the mean absolute error between the target and
         the reconstruction where the mean is taken over values where
         the target is equal to zero.
-        This can be NaN if there are no inputs equal to zero.
+        This is zero if there are no inputs equal to zero.
     """
     _, _, x, y, z = target.shape
     begin = [0, 0, 3, 3, 3]
@@ -6,21 +6,28 @@ Created on Mon Aug 10 11:11:57 2020
 @author: scantleb
 @brief: Use trained autoencoder to calculate encodings for gnina inputs.
 """
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Queue
 
 import molgrid
+import numpy as np
+import pandas as pd
 import tensorflow as tf
 
+from autoencoder.autoencoder_definitions import AutoEncoderBase
 from autoencoder.parse_command_line_args import parse_command_line_args
 from utilities import gnina_embeddings_pb2, gnina_functions
-from utilities.gnina_functions import write_process_info
+from utilities.gnina_functions import grid_to_tensor, write_process_info
 from utilities.reorder_types_file import reorder
 
 
 def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
                         dimension, resolution, rotate=False, ligmap=None,
-                        recmap=None, binary_mask=False):
+                        recmap=None, binary_mask=False,
+                        embedding_dtype='float32'):
     """Calculates encodings for gnina inputs.
 
     Uses trained AutoEncoder object to calculate the encodings of all gnina
@@ -40,68 +47,88 @@ def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
         ligmap: Text file containing definitions of ligand input channels
         recmap: Text file containing definitions of receptor input channels
         binary_mask:
+        embedding_dtype: precision with which embeddings are stored; one of
+            'float32', 'float16' or 'int8'. Reduced precision shrinks the
+            serialised encodings by 2x/4x; int8 vectors are quantised with a
+            per-vector scale which is stored alongside them.
 
     Returns:
         Dictionary of serialised protein protobuf messages with structure
         defined in gnina_encodings.proto. The structure is:
 
             {receptor_path : serialised_protobuf_messages (1 per ligand)}
+
+    Raises:
+        ValueError: if embedding_dtype is not a recognised precision
     """
+    # Validate up front; an unknown dtype would otherwise only fail once
+    # the first encodings reach the background writer thread
+    if embedding_dtype not in ('float32', 'float16', 'int8'):
+        raise ValueError(
+            'embedding_dtype must be one of float32, float16 or int8 '
+            '(got {})'.format(embedding_dtype))
 
     def get_paths(fname):
         """Reads types file to give path, label and indexing information.
 
+        The types file is parsed in a single vectorised pass rather than a
+        per-line python loop.
+
         Arguments:
             fname: types file with lines of the format:
                 <label> <receptor_path> <ligand_path>
 
-        Returns a dictionary mapping of { global_idx: (label, rec, lig) } where
-        global_idx is the position of the receptor/ligand pair in the types
-        file, label is in {0, 1}, and rec and lig are the relative paths to
-        the receptor and ligand gninatypes files, respectively.
+        Returns a tuple containing a flag which is True if a temporary
+        reordered types file was created (and should be deleted after use),
+        the types file which should be fed to molgrid, and three arrays
+        holding the label (in {0, 1}), receptor path and ligand path for
+        each line of that types file, indexed by position in the file.
         """
-        result_paths = {}
-        recs = set()
-        curr_rec = None
-        with open(fname, 'r') as f:
-            for idx, line in enumerate(f.readlines()):
-                chunks = line.strip().split()
-                lab = int(chunks[0])
-                rec_path = chunks[1]
-                lig_path = chunks[2]
-                if idx == 0:
-                    curr_rec = rec_path
-                    recs.add(rec_path)
-                elif rec_path != curr_rec:
-                    if rec_path in recs:
-                        # We have a types file unordered by receptor; create a
-                        # temp ordered file, extract what we need, then delete.
-                        reordered_types_file = reorder(fname)
-                        tmp_types_file = save_path / 'tmp_types_file.types'
-                        with open(tmp_types_file, 'w') as tmp:
-                            tmp.write(reordered_types_file)
-                        _, _, result_paths = get_paths(tmp_types_file)
-                        return True, tmp_types_file, result_paths
-                    else:
-                        recs.add(rec_path)
-                        curr_rec = rec_path
-                result_paths[idx] = (lab, rec_path, lig_path)
-        return False, fname, result_paths
-
-    def write_encodings_to_disk(receptor, enc):
+        df = pd.read_csv(fname, sep=r'\s+', header=None, usecols=[0, 1, 2],
+                         names=['label', 'rec', 'lig'])
+
+        # A types file is grouped by receptor iff each receptor appears in
+        # exactly one contiguous block of lines
+        blocks = (df['rec'] != df['rec'].shift()).cumsum()
+        if blocks.groupby(df['rec']).nunique().max() > 1:
+            # We have a types file unordered by receptor; create a
+            # temp ordered file, extract what we need, then delete.
+            reordered_types_file = reorder(fname)
+            tmp_types_file = save_path / 'tmp_types_file.types'
+            with open(tmp_types_file, 'w') as tmp:
+                tmp.write(reordered_types_file)
+            _, _, labels, recs, ligs = get_paths(tmp_types_file)
+            return True, tmp_types_file, labels, recs, ligs
+        return (False, fname, df['label'].to_numpy(dtype=np.int8),
+                df['rec'].to_numpy(), df['lig'].to_numpy())
+
+    def write_encodings_to_disk(receptor, enc_labels, enc_ligs, enc_rows):
         """Write encodings to disk in serialised binary format.
 
         Arguments:
             receptor: path to receptor gninatypes file
-            enc: iterable of tuples, each containing a label, a ligand path and
-                a ligand encoding (numpy array)
+            enc_labels: sequence of labels
+            enc_ligs: sequence of ligand paths
+            enc_rows: sequence of ligand encodings (numpy arrays)
         """
         rec_msg = gnina_embeddings_pb2.protein()
         rec_msg.path = receptor
-        for lab, lig_path, lig_encoding in enc:
+        for lab, lig_path, lig_encoding in zip(enc_labels, enc_ligs, enc_rows):
             lig_msg = rec_msg.ligand.add()
             lig_msg.path = lig_path
-            lig_msg.embedding.extend(lig_encoding)
+            # Embeddings are stored as raw little-endian bytes, so
+            # serialisation is a memcpy rather than per-float encoding
+            lig_encoding = np.asarray(lig_encoding, dtype=np.float32)
+            if embedding_dtype == 'int8':
+                scale = float(np.max(np.abs(lig_encoding))) / 127.
+                scale = scale if scale > 0 else 1.
+                lig_msg.embedding = np.round(
+                    lig_encoding / scale).astype(np.int8).tobytes()
+                lig_msg.scale = scale
+            else:
+                lig_msg.embedding = lig_encoding.astype(
+                    embedding_dtype).tobytes()
+            lig_msg.dtype = embedding_dtype
             lig_msg.label = lab
 
         fname = Path(receptor).stem + '.bin'
@@ -116,7 +143,7 @@ def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
     # Logging process ID is useful for memory profiling (see utilities)
     write_process_info(__file__, save_path)
 
-    delete_types_file, types_file, paths = get_paths(types_file)
+    delete_types_file, types_file, labels, recs, ligs = get_paths(types_file)
 
     # Setup libmolgrid to feed Examples into tensorflow objects
     example_provider_kwargs = {
@@ -148,16 +175,22 @@ def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
     # noinspection PyArgumentList
     dims = gmaker.grid_dimensions(e_test.num_types())
     tensor_shape = (batch_size,) + dims
-    input_tensor = molgrid.MGrid5f(*tensor_shape)
 
-    # Need a dictionary mapping {global_idx: (label, rec, lig) where global_idx
-    # is the position of the receptor/ligand pair in the types file
-    total_size = len(paths)
+    # Two persistent grid buffers used in ping-pong fashion: while the model
+    # works on one, the next batch is gridded into the other
+    input_tensors = [molgrid.MGrid5f(*tensor_shape),
+                     molgrid.MGrid5f(*tensor_shape)]
+
+    # Labels, receptor and ligand paths are indexed by the position of the
+    # receptor/ligand pair in the types file
+    total_size = len(labels)
     iterations = total_size // batch_size
 
-    # Inference (obtain encodings)
-    current_rec = paths[0][1]
-    encodings = []
+    # Inference (obtain encodings); the accumulator is kept as three
+    # parallel arrays (labels, ligand paths, encoding rows) rather than a
+    # list of per-ligand tuples
+    current_rec = recs[0]
+    enc_labels, enc_ligs, enc_rows = [], [], []
     start_time = time.time()
 
     try:
@@ -167,32 +200,94 @@ def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
     else:
         composite = True
 
-    for iteration in range(iterations):
+    # Use the model's own traced inference path where available (see
+    # AutoEncoderBase.infer). Models restored with load_model are not
+    # AutoEncoderBase objects and their saved infer attribute is a
+    # RestoredFunction which only accepts the exact signature it was traced
+    # with (if any), so for those trace an equivalent function locally.
+    # Reusing a single traced function avoids both the per-batch graph
+    # construction and the predict_on_batch memory leak which previously
+    # required clear_session to be called on every iteration.
+    if isinstance(encoder, AutoEncoderBase):
+        infer = encoder.infer
+    else:
+        @tf.function
+        def infer(inputs):
+            return encoder(inputs, training=False)
 
-        # There is a memory leak with predict_on_batch(), this workaround seems
-        # to prevent it.
-        tf.keras.backend.clear_session()
+    # Protobuf serialisation and disk writes happen on a background thread
+    # so they overlap with gridding and inference of subsequent batches
+    write_queue = Queue()
+    writer_errors = []
 
-        batch = e_test.next_batch(batch_size)
-        gmaker.forward(batch, input_tensor, 0, random_rotation=rotate)
+    def writer():
+        """Consume (receptor, labels, ligands, rows) until a None sentinel.
+
+        Exceptions are captured rather than allowed to kill the thread
+        silently; they are re-raised in the main thread after join().
+        """
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            try:
+                write_encodings_to_disk(*item)
+            except Exception as e:
+                writer_errors.append(e)
+                break
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+
+    # The final (possibly partial) batch is handled by the same loop body as
+    # the full batches; molgrid pads the batch, and only the first
+    # <remainder> outputs of the final batch are kept.
+    remainder = total_size % batch_size
+    total_iterations = iterations + (1 if remainder else 0)
 
-        inputs = [input_tensor.tonumpy()]
+    def fill_grid(tensor):
+        """Grid the next batch of examples into the given buffer."""
+        batch = e_test.next_batch(batch_size)
+        gmaker.forward(batch, tensor, 0, random_rotation=rotate)
+        return tensor
+
+    # Gridding of batch n+1 happens on a worker thread while the model
+    # performs inference on batch n; a buffer is only re-filled two
+    # iterations after it was gridded, by which point inference on it has
+    # completed.
+    gridder = ThreadPoolExecutor(max_workers=1)
+    pending = gridder.submit(fill_grid, input_tensors[0])
+
+    for iteration in range(total_iterations):
+        input_tensor = pending.result()
+        if iteration + 1 < total_iterations:
+            pending = gridder.submit(
+                fill_grid, input_tensors[(iteration + 1) % 2])
+
+        # Zero-copy import of the grid where the molgrid build supports it;
+        # keeping the tensor in `inputs` holds a reference across the call
+        inputs = [grid_to_tensor(input_tensor)]
         if composite:  # We don't use this but is needed for a valid model
-            inputs.append(tf.constant(1., shape=(batch_size,)))
-        _, encodings_numpy = encoder.predict_on_batch(inputs)
+            inputs.append(gnina_functions.ones(batch_size))
+        _, encoding_batch = infer(inputs)
+        encodings_numpy = encoding_batch.numpy()
 
-        for batch_idx in range(batch_size):
+        keep = batch_size if iteration < iterations else remainder
+        for batch_idx in range(keep):
             global_idx = iteration * batch_size + batch_idx
-            label, rec, lig = paths[global_idx]
+            label, rec, lig = \
+                labels[global_idx], recs[global_idx], ligs[global_idx]
             if rec != current_rec:
-                write_encodings_to_disk(current_rec, encodings)
-                encodings = []
+                write_queue.put((current_rec, enc_labels, enc_ligs, enc_rows))
+                enc_labels, enc_ligs, enc_rows = [], [], []
                 current_rec = rec
-            encodings.append((label, lig, encodings_numpy[batch_idx, :]))
+            enc_labels.append(label)
+            enc_ligs.append(lig)
+            enc_rows.append(encodings_numpy[batch_idx, :])
 
         time_elapsed = time.time() - start_time
         time_per_iter = time_elapsed / (iteration + 1)
-        time_remaining = time_per_iter * (iterations - iteration - 1)
+        time_remaining = time_per_iter * (total_iterations - iteration - 1)
         formatted_eta = gnina_functions.format_time(time_remaining)
 
         if not iteration:
@@ -200,30 +295,18 @@ def calculate_encodings(encoder, data_root, batch_size, types_file, save_path,
 
         console_output = ('Iteration: {0}/{1}\n' +
                           'Time elapsed {2} | Time remaining: {3}').format(
-            iteration, iterations, gnina_functions.format_time(time_elapsed),
-            formatted_eta)
+            iteration, total_iterations,
+            gnina_functions.format_time(time_elapsed), formatted_eta)
         gnina_functions.print_with_overwrite(console_output)
 
-    remainder = total_size % batch_size
-    batch = e_test.next_batch(batch_size)
-    gmaker.forward(batch, input_tensor, 0, random_rotation=rotate)
-
-    inputs = [input_tensor.tonumpy()]
-    if composite:
-        inputs.append(tf.constant(1., shape=(batch_size,)))
-    _, encodings_numpy = encoder.predict_on_batch(inputs)
-
-    for batch_idx in range(remainder):
-        global_idx = iterations * batch_size + batch_idx
-        label, rec, lig = paths[global_idx]
-        if rec != current_rec:
-            write_encodings_to_disk(current_rec, encodings)
-            encodings = []
-            current_rec = rec
-        encodings.append((label, lig, encodings_numpy[batch_idx, :]))
+    if len(enc_ligs):  # Encodings that have not been saved (final receptor)
+        write_queue.put((current_rec, enc_labels, enc_ligs, enc_rows))
 
-    if len(encodings):  # Encodings that have not been saved (final receptor)
-        write_encodings_to_disk(current_rec, encodings)
+    gridder.shutdown()
+    write_queue.put(None)  # Sentinel; all work has been submitted
+    writer_thread.join()
+    if writer_errors:  # Encodings were not all written; fail loudly
+        raise writer_errors[0]
 
 
 if __name__ == '__main__':
@@ -242,6 +325,7 @@ if __name__ == '__main__':
             batch_size=args.batch_size, types_file=args.test,
             save_path=save_path, dimension=args.dimension,
             resolution=args.resolution, rotate=False, ligmap=args.ligmap,
-            recmap=args.recmap, binary_mask=args.binary_mask)
+            recmap=args.recmap, binary_mask=args.binary_mask,
+            embedding_dtype=args.embedding_dtype)
     print('Encodings calculated and saved in {} s'.format(t.interval))
     print('Encodings written to {}'.format(save_path))
@@ -232,7 +232,8 @@ def main():
                                 ligmap=args.ligmap,
                                 recmap=args.recmap,
                                 rotate=False,
-                                binary_mask=args.binary_mask
+                                binary_mask=args.binary_mask,
+                                embedding_dtype=args.embedding_dtype
                                 )
         print('Encodings calculated and saved to {0} in {1} s'.format(
             save_path / 'encodings', t.interval))
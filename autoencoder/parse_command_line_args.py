@@ -265,6 +265,12 @@ def parse_command_line_args(test_or_train='train'):
 
     parser.add_argument("--data_root", '-r', type=str, required=False,
                         default='')
+    parser.add_argument(
+        '--embedding_dtype', type=str, required=False, default='float32',
+        choices=['float32', 'float16', 'int8'],
+        help='Precision with which calculated encodings are serialised; one '
+             'of float32, float16 or int8 (int8 vectors are stored with a '
+             'per-vector dequantisation scale).')
     parser.add_argument(
         '--save_path', '-s', type=str, required=False, default='.')
     parser.add_argument(
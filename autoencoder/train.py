@@ -85,7 +85,7 @@ def train(model, data_root, train_types, iterations, batch_size,
         e = molgrid.ExampleProvider(
             rec_typer, lig_typer, **example_provider_kwargs)
         with open(recmap, 'r') as f:
-            rec_channels = len([line for line in f.readlines() if len(line)])
+            rec_channels = sum(1 for _ in f)
     e.populate(str(Path(train_types).expanduser()))
 
     # noinspection PyArgumentList
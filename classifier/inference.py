@@ -108,7 +108,6 @@ def inference(model, test_types, data_root, save_path, batch_size, labels=None,
     iterations = size // batch_size
     with Timer() as t:
         for iteration in range(iterations):
-            tf.keras.backend.clear_session()
             labels_numpy, predictions = process_batch(
                 model, e_test, gmaker, input_tensor, labels_tensor=labels,
                 train=False, autoencoder=None)
@@ -50,7 +50,14 @@ def get_embeddings_arr(directory):
         target_path = encodings.path
         for ligand_struct in encodings.ligand:
             label = ligand_struct.label
-            embeddings.append(np.array(ligand_struct.embedding))
+            # An empty dtype field implies float32 (older encodings)
+            dtype = ligand_struct.dtype or 'float32'
+            embedding = np.frombuffer(ligand_struct.embedding, dtype=dtype)
+            if dtype == 'int8':
+                embedding = embedding.astype(np.float32) * ligand_struct.scale
+            elif dtype != 'float32':
+                embedding = embedding.astype(np.float32)
+            embeddings.append(embedding)
             labels.append(label)
             ligand_path = ligand_struct.path
             paths.append((target_path, ligand_path))
@@ -7,10 +7,37 @@ Created on Fri Sep 11 09:12:15 2020
 @brief: Functions for generating keras layers.
 """
 
+from functools import lru_cache
+
 import tensorflow as tf
 from tensorflow.keras import layers
 
 
+@lru_cache(maxsize=None)
+def _activation_layer_spec(activation):
+    """Resolve an activation string to a layer class and its arguments.
+
+    Memoised so that repeated model constructions (for example during
+    hyperparameter sweeps) perform the string dispatch once per activation
+    function rather than once per layer; layer instances themselves cannot
+    be shared between models so are still created per layer.
+
+    Arguments:
+        activation: string representing an activation function (see
+            generate_activation_layers)
+
+    Returns:
+        Tuple of a keras layer class and a dictionary of keyword arguments
+        with which it should be instantiated.
+    """
+    if activation == 'prelu':
+        return layers.PReLU, {
+            'alpha_initializer': tf.keras.initializers.constant(0.1)}
+    if activation == 'threlu':
+        return layers.ThresholdedReLU, {'theta': 1.0}
+    return layers.Activation, {'activation': activation}
+
+
 def generate_activation_layers(block_name, activation, append_name_info=True):
     """Generate activation layers from strings representing activation layers.
 
@@ -26,6 +53,7 @@ def generate_activation_layers(block_name, activation, append_name_info=True):
         Generator which produces layers with names containing increasing
         index numbers, with the specified activation function and base name.
     """
+    layer_class, layer_kwargs = _activation_layer_spec(activation)
     name_template = '{0}_{{0}}_{1}'.format(block_name, activation)
     block_name_index = 0
     while True:
@@ -34,11 +62,4 @@ def generate_activation_layers(block_name, activation, append_name_info=True):
         else:
             act_name = block_name
         block_name_index += 1
-        if activation == 'prelu':
-            yield layers.PReLU(
-                name=act_name,
-                alpha_initializer=tf.keras.initializers.constant(0.1))
-        elif activation == 'threlu':
-            yield layers.ThresholdedReLU(theta=1.0, name=act_name)
-        else:
-            yield layers.Activation(activation, name=act_name)
+        yield layer_class(name=act_name, **layer_kwargs)
@@ -15,6 +15,7 @@ import tensorflow as tf
 
 from autoencoder import autoencoder_definitions
 from autoencoder.calculate_encodings import calculate_encodings
+from classifier.random_forest import get_embeddings_arr
 from utilities import gnina_embeddings_pb2 as ge
 from utilities.gnina_functions import wipe_directory
 
@@ -61,7 +62,62 @@ def test_calculate_encodings():
         for ligand_struct in encodings.ligand:
             label = ligand_struct.label
             ligand_path = ligand_struct.path
-            assert np.array(ligand_struct.embedding).shape == (5,)
+            embedding = np.frombuffer(
+                ligand_struct.embedding, dtype=np.float32)
+            assert embedding.shape == (5,)
             assert labels[rec_path][ligand_path] == label
 
     wipe_directory(temporary_directory)
+
+
+def test_reduced_precision_encodings():
+    """Round-trip test for reduced precision encoding storage.
+
+    Encodings serialised as float16 and int8 should dequantise (via
+    get_embeddings_arr) to within quantisation error of the float32
+    encodings of the same inputs.
+    """
+    autoencoder = tf.keras.models.load_model(
+        'test/models/test_autoencoder',
+        custom_objects={
+            'zero_mse': autoencoder_definitions.zero_mse,
+            'nonzero_mse': autoencoder_definitions.nonzero_mse,
+            'composite_mse': autoencoder_definitions.composite_mse,
+            'nonzero_mae': autoencoder_definitions.nonzero_mae,
+            'zero_mae': autoencoder_definitions.zero_mae,
+        }
+    )
+
+    ligmap = 'test/resources/gnina35.ligmap'
+    recmap = 'test/resources/gnina35.recmap'
+    temporary_directory = Path('test/tmp_save_path')
+    temporary_directory.mkdir(parents=True, exist_ok=True)
+
+    # A short types file keeps the three encoding runs fast
+    with open('data/small_chembl_test.types', 'r') as f:
+        lines = f.readlines()[:32]
+    types_file = temporary_directory / 'reduced_precision.types'
+    with open(types_file, 'w') as f:
+        f.write(''.join(lines))
+
+    embeddings = {}
+    for dtype in ('float32', 'float16', 'int8'):
+        calculate_encodings(
+            autoencoder, data_root='data', batch_size=16,
+            types_file=types_file, save_path=temporary_directory / dtype,
+            dimension=18., resolution=1., rotate=False, ligmap=ligmap,
+            recmap=recmap, binary_mask=False, embedding_dtype=dtype)
+        arr, _, path_dict = get_embeddings_arr(
+            temporary_directory / dtype / 'encodings')
+        order = sorted(range(len(arr)), key=lambda idx: path_dict[idx])
+        embeddings[dtype] = arr[order]
+
+    reference = embeddings['float32']
+    assert np.allclose(reference, embeddings['float16'],
+                       rtol=1e-3, atol=1e-3)
+
+    # int8 error is bounded by half the per-vector quantisation step
+    step = np.max(np.abs(reference), axis=1, keepdims=True) / 127.
+    assert np.all(np.abs(reference - embeddings['int8']) <= 0.5 * step + 1e-6)
+
+    wipe_directory(temporary_directory)
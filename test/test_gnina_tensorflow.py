@@ -74,3 +74,26 @@ def test_format_time():
     assert gf.format_time(1000) == gf.format_time(1000.9)
     assert gf.format_time(1234) == '00:20:34'
     assert gf.format_time(1e6) == '277:46:40'
+
+
+def test_prune_kernel_2_4():
+    """Unit test for prune_kernel_2_4.
+
+    Every group of four consecutive weights along the input dimension
+    should contain exactly two zeros, and the surviving weights should be
+    the two largest in magnitude, unchanged.
+    """
+    from autoencoder.autoencoder_definitions import prune_kernel_2_4
+
+    rng = np.random.default_rng(0)
+    kernel = rng.standard_normal((64, 10)).astype('float32')
+    pruned = prune_kernel_2_4(kernel)
+
+    assert pruned.shape == kernel.shape
+    groups = pruned.reshape(-1, 4, kernel.shape[1])
+    assert np.all(np.count_nonzero(groups, axis=1) == 2)
+
+    original_groups = kernel.reshape(-1, 4, kernel.shape[1])
+    largest = np.sort(np.abs(original_groups), axis=1)[:, 2:, :]
+    survivors = np.sort(np.abs(groups), axis=1)[:, 2:, :]
+    assert np.allclose(largest, survivors)
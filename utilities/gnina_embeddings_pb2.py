@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   syntax='proto3',
   serialized_options=None,
   create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\x16gnina_embeddings.proto\x12\x11gnina_autoencoder\"K\n\x06ligand\x12\x0c\n\x04path\x18\x01 \x01(\t\x12\x15\n\tembedding\x18\x02 \x03(\x02\x42\x02\x10\x01\x12\x12\n\x05label\x18\x03 \x01(\x05H\x00\x88\x01\x01\x42\x08\n\x06_label\"B\n\x07protein\x12\x0c\n\x04path\x18\x01 \x01(\t\x12)\n\x06ligand\x18\x02 \x03(\x0b\x32\x19.gnina_autoencoder.ligandb\x06proto3'
+  serialized_pb=b'\n\x16gnina_embeddings.proto\x12\x11gnina_autoencoder\"e\n\x06ligand\x12\x0c\n\x04path\x18\x01 \x01(\t\x12\x11\n\tembedding\x18\x02 \x01(\x0c\x12\x12\n\x05label\x18\x03 \x01(\x05H\x00\x88\x01\x01\x12\r\n\x05\x64type\x18\x04 \x01(\t\x12\r\n\x05scale\x18\x05 \x01(\x02\x42\x08\n\x06_label\"B\n\x07protein\x12\x0c\n\x04path\x18\x01 \x01(\t\x12)\n\x06ligand\x18\x02 \x03(\x0b\x32\x19.gnina_autoencoder.ligandb\x06proto3'
 )
 
 
@@ -42,11 +42,11 @@ _LIGAND = _descriptor.Descriptor(
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
     _descriptor.FieldDescriptor(
       name='embedding', full_name='gnina_autoencoder.ligand.embedding', index=1,
-      number=2, type=2, cpp_type=6, label=3,
-      has_default_value=False, default_value=[],
+      number=2, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"",
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
-      serialized_options=b'\020\001', file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
     _descriptor.FieldDescriptor(
       name='label', full_name='gnina_autoencoder.ligand.label', index=2,
       number=3, type=5, cpp_type=1, label=1,
@@ -54,6 +54,20 @@ _LIGAND = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='dtype', full_name='gnina_autoencoder.ligand.dtype', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='scale', full_name='gnina_autoencoder.ligand.scale', index=4,
+      number=5, type=2, cpp_type=6, label=1,
+      has_default_value=False, default_value=float(0),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -72,7 +86,7 @@ _LIGAND = _descriptor.Descriptor(
     fields=[]),
   ],
   serialized_start=45,
-  serialized_end=120,
+  serialized_end=146,
 )
 
 
@@ -110,8 +124,8 @@ _PROTEIN = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=122,
-  serialized_end=188,
+  serialized_start=148,
+  serialized_end=214,
 )
 
 _LIGAND.oneofs_by_name['_label'].fields.append(
@@ -137,5 +151,4 @@ protein = _reflection.GeneratedProtocolMessageType('protein', (_message.Message,
 _sym_db.RegisterMessage(protein)
 
 
-_LIGAND.fields_by_name['embedding']._options = None
 # @@protoc_insertion_point(module_scope)
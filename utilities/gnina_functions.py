@@ -8,7 +8,9 @@ Created on Fri Jul 10 14:47:44 2020
 import math
 import os
 import shutil
+import sys
 import time
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -82,6 +84,31 @@ def wipe_directory(directory):
     directory.rmdir()
 
 
+def grid_to_tensor(grid):
+    """Convert a molgrid MGrid object to a tensorflow tensor.
+
+    Newer libmolgrid builds expose the underlying (possibly GPU-resident)
+    buffer through DLPack or torch interop; importing that buffer directly
+    into tensorflow avoids both the device-to-host copy made by tonumpy()
+    and the host-to-device copy made when the resulting array is fed back
+    to a model. Older builds fall back to the tonumpy() copy.
+
+    Arguments:
+        grid: molgrid.MGrid<x>f object
+
+    Returns:
+        tensorflow tensor containing the contents of the grid
+    """
+    if hasattr(grid, 'todlpack'):
+        return tf.experimental.dlpack.from_dlpack(grid.todlpack())
+    if hasattr(grid, 'torch'):
+        # noinspection PyUnresolvedReferences
+        import torch.utils.dlpack
+        return tf.experimental.dlpack.from_dlpack(
+            torch.utils.dlpack.to_dlpack(grid.torch()))
+    return tf.convert_to_tensor(grid.tonumpy())
+
+
 def get_dims(dimension, resolution, ligmap, recmap):
     """Get the dimensions for a given dimension, resolution and channel setting.
 
@@ -102,7 +129,7 @@ def get_dims(dimension, resolution, ligmap, recmap):
             c = 14
         else:
             with open(fname, 'r') as f:
-                c = sum([1 for line in f.readlines() if len(line)])
+                c = sum(1 for _ in f)
         channels += c
     length = int(dimension // resolution) + 1
     return channels, length, length, length
@@ -127,21 +154,33 @@ def format_time(t):
     return '{0:02d}:{1:02d}:{2:02d}'.format(h, m, s)
 
 
+# Terminal width is cached and only refreshed periodically;
+# print_with_overwrite sits inside training loops and querying the width
+# is a syscall
+_TERMINAL_REFRESH_INTERVAL = 100
+_terminal_width = shutil.get_terminal_size((0, 20)).columns
+_overwrite_calls = 0
+
+
 def print_with_overwrite(s):
     """Prints to console, but overwrites previous output, rather than creating
     a newline.
-    
+
     Arguments:
         s: string (possibly with multiple lines) to print
     """
+    global _terminal_width, _overwrite_calls
+    if not _overwrite_calls % _TERMINAL_REFRESH_INTERVAL:
+        _terminal_width = shutil.get_terminal_size((0, 20)).columns
+    _overwrite_calls += 1
     ERASE = '\x1b[2K'
     UP_ONE = '\x1b[1A'
     lines = s.split('\n')
-    n_lines = len(lines)
-    console_width = shutil.get_terminal_size((0, 20)).columns
-    for idx in range(n_lines):
-        lines[idx] += ' ' * max(0, console_width - len(lines[idx]))
-    print((ERASE + UP_ONE) * (n_lines - 1) + s, end='\r', flush=True)
+    # Lines are padded to the terminal width so that leftovers from longer
+    # previous output are overwritten; everything is emitted in one write
+    out = '\n'.join(line.ljust(_terminal_width) for line in lines)
+    sys.stdout.write((ERASE + UP_ONE) * (len(lines) - 1) + out + '\r')
+    sys.stdout.flush()
 
 
 def get_test_info(test_file):
@@ -159,12 +198,64 @@ def get_test_info(test_file):
     """
     paths = {}
     with open(test_file, 'r') as f:
-        for idx, line in enumerate(f.readlines()):
+        for idx, line in enumerate(f):
             chunks = line.strip().split()
             paths[idx] = (chunks[-2], chunks[-1])
     return paths, len(paths)
 
 
+@lru_cache(maxsize=8)
+def ones(batch_size):
+    """Memoised vector of ones, used as a dummy frac input.
+
+    Constructing a constant tensor allocates and dispatches on every call;
+    the batch size rarely changes within a run so the tensor is cached.
+
+    Arguments:
+        batch_size: length of the vector
+
+    Returns:
+        Rank 1 tensorflow tensor of ones with shape (batch_size,)
+    """
+    return tf.constant(1., shape=(batch_size,))
+
+
+# Traced forward passes, keyed on the participating models so that each
+# (model, autoencoder) pair is traced exactly once
+_inference_fns = {}
+
+
+def _inference_fn(model, autoencoder=None):
+    """Return a traced forward pass through the autoencoder and model.
+
+    Tracing the step once and reusing the resulting function avoids the
+    per-call dispatch machinery (and retracing) of predict_on_batch, and
+    lets the autoencoder reconstruction and the downstream model be fused
+    into a single graph.
+
+    Arguments:
+        model: compiled tensorflow model
+        autoencoder: optional trained autoencoder; if provided, inputs are
+            passed through it and the reconstruction is fed to the model
+
+    Returns:
+        tf.function mapping model (or autoencoder) inputs to model outputs.
+    """
+    key = (id(model), id(autoencoder))
+    fn = _inference_fns.get(key)
+    if fn is None:
+        if autoencoder is None:
+            def step(x):
+                return model(x, training=False)
+        else:
+            def step(x):
+                reconstruction, _ = autoencoder(x, training=False)
+                return model(reconstruction, training=False)
+        fn = tf.function(step)
+        _inference_fns[key] = fn
+    return fn
+
+
 def process_batch(model, example_provider, gmaker, input_tensor,
                   labels_tensor=None, train=True, autoencoder=None):
     """Feeds forward and backpropagates (if train==True) batch of examples.
@@ -202,37 +293,40 @@ def process_batch(model, example_provider, gmaker, input_tensor,
     batch = example_provider.next_batch(batch_size)
     gmaker.forward(batch, input_tensor, 0, random_rotation=train)
 
-    input_numpy = input_tensor.tonumpy()
-    tf.keras.backend.clear_session()
+    # Zero-copy import of the grid where the molgrid build supports it
+    input_tensor_tf = grid_to_tensor(input_tensor)
 
     if autoencoder is not None:
-        inputs = {'input_image': input_numpy}
+        inputs = {'input_image': input_tensor_tf}
         try:
             autoencoder.get_layer('frac')
         except ValueError:
             pass
         else:
-            inputs.update({'frac': tf.constant(1., shape=(batch_size,))})
+            inputs.update({'frac': ones(batch_size)})
         try:
             autoencoder.get_layer('distances')
         except ValueError:
             pass
         else:
-            inputs.update({'distances': np.zeros_like(input_numpy)})
-        gnina_input, _ = autoencoder.predict_on_batch(inputs)
+            inputs.update({'distances': tf.zeros_like(input_tensor_tf)})
     else:
-        gnina_input = input_numpy
+        inputs = input_tensor_tf
 
     if labels_tensor is None:  # We don't know labels; just return predictions
-        return model.predict_on_batch(gnina_input)
+        return _inference_fn(model, autoencoder)(inputs).numpy()
 
     batch.extract_label(0, labels_tensor)  # y_true
     if train:  # Return loss
+        if autoencoder is not None:
+            gnina_input, _ = _inference_fn(autoencoder)(inputs)
+        else:
+            gnina_input = inputs
         return model.train_on_batch(
             gnina_input, labels_tensor.tonumpy())
     else:  # Return labels, predictions
         return (labels_tensor.tonumpy(),
-                model.predict_on_batch(gnina_input))
+                _inference_fn(model, autoencoder)(inputs).numpy())
 
 
 def _calculate_ligand_distances(rec_channels, input_tensor, point_dist):